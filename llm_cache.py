@@ -0,0 +1,118 @@
+"""
+Exact-match reply cache for the coach LLM helpers.
+
+Prompts collapse to a handful of templates per task text, so identical
+(reason, text) pairs are answered from RAM instead of another OpenAI call.
+Entries are LRU-evicted past `max_entries` and expire after `ttl` seconds.
+Identical calls that are already in flight share one network request.
+`ReplyCache` keeps entries in process; `RedisReplyCache` shares them across
+workers/restarts under `llm:<sha256>` keys.
+"""
+
+import asyncio, hashlib, time
+from collections import OrderedDict
+from functools import wraps
+from typing import Dict, Optional, Protocol, Tuple
+
+EXCLUDE_REASONS = {"stuck"}   # dynamic advice – always hits the LLM
+
+
+def normalize(text: str) -> str:
+    """lowercase + trim + collapse whitespace"""
+    return " ".join(text.lower().split())
+
+
+def cache_key(reason: str, text: str) -> str:
+    return hashlib.sha256(f"{reason}|{normalize(text)}".encode()).hexdigest()
+
+
+class ReplyStore(Protocol):
+    """what cached_reply needs: ReplyCache or RedisReplyCache"""
+    async def get(self, key: str) -> Optional[str]: ...
+    async def set(self, key: str, value: str): ...
+
+
+class ReplyCache:
+    def __init__(self, max_entries: int = 10_000, ttl: float = 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expiry = entry
+        if expiry < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+
+class RedisReplyCache:
+    """Same interface as ReplyCache, backed by `SET llm:<key> <resp> EX ttl`."""
+    def __init__(self, redis, ttl: float = 60 * 60, prefix: str = "llm:"):
+        self.redis = redis    # redis.asyncio client with decode_responses=True
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.redis.get(self.prefix + key)
+
+    async def set(self, key: str, value: str):
+        await self.redis.set(self.prefix + key, value, ex=self.ttl)
+
+
+class _LeaderCancelled(Exception):
+    """the coalesced call was cancelled; waiters retry on their own"""
+
+
+def cached_reply(cache: ReplyStore):
+    """Decorate `async def f(reason, text) -> str`: LRU → in-flight → network."""
+    def decorator(fn):
+        _inflight: Dict[str, asyncio.Future] = {}
+
+        @wraps(fn)
+        async def wrapper(reason: str, text: str) -> str:
+            key = cache_key(reason, text)
+            cacheable = reason not in EXCLUDE_REASONS
+            if cacheable:
+                hit = await cache.get(key)
+                if hit is not None:
+                    return hit                # skips llm_sema + network
+            fut = _inflight.get(key)
+            if fut is not None:
+                try:
+                    # single-flight: ride the first caller; shield so our own
+                    # cancellation doesn't cancel the shared future
+                    return await asyncio.shield(fut)
+                except _LeaderCancelled:
+                    return await wrapper(reason, text)
+            fut = asyncio.get_running_loop().create_future()
+            _inflight[key] = fut
+            try:
+                try:
+                    resp = await fn(reason, text)
+                except asyncio.CancelledError:
+                    fut.set_exception(_LeaderCancelled())
+                    fut.exception()
+                    raise
+                except Exception as e:
+                    fut.set_exception(e)
+                    fut.exception()           # mark retrieved so a waiter-less future doesn't log
+                    raise
+                fut.set_result(resp)
+                if cacheable:
+                    await cache.set(key, resp)   # still in flight, so no duplicate call meanwhile
+                return resp
+            finally:
+                _inflight.pop(key, None)
+        return wrapper
+    return decorator
@@ -1,6 +1,10 @@
 import os, json, asyncio
+import orjson
 from fastapi import FastAPI, Request
-from aiogram import Bot, types
+from fastapi.responses import ORJSONResponse
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
 from dotenv import load_dotenv
 load_dotenv()           # pulls vars from .env in the current directory
@@ -15,20 +19,42 @@ print("API_ROOT:", API_ROOT)
 print(BOT_TOKEN)
 print(API_ROOT)
 
-bot = Bot(BOT_TOKEN, api_root=API_ROOT)   # no parse_mode here
+# one pooled, keep-alive session for every Telegram call
+session = AiohttpSession(api=TelegramAPIServer.from_base(API_ROOT), limit=200)
+session._connector_init.update(limit_per_host=100, ttl_dns_cache=300, keepalive_timeout=75)
+bot = Bot(BOT_TOKEN, session=session)   # no parse_mode here
 
 app = FastAPI()
 
+@app.on_event("shutdown")
+async def _close_bot_session():
+    await bot.session.close()
+
+_background: set = set()   # strong refs so pending updates aren't GC'd
+
 @app.post("/telegram/webhook")
 async def telegram_webhook(req: Request):
-    update = types.Update(**await req.json())
-    if update.message and update.message.text:
-        chat_id = update.message.chat.id
-        if update.message.text.lower() == "/start":
+    # ack Telegram right away; the update is handled in the background
+    payload = orjson.loads(await req.body())
+    task = asyncio.create_task(_process_update(payload))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return ORJSONResponse({"ok": True})
+
+async def _process_update(payload: dict):
+    # fast path: read chat id / text straight off the dict, no pydantic
+    msg = payload.get("message") or {}
+    if msg.get("text"):
+        chat_id = msg["chat"]["id"]
+        if msg["text"].lower() == "/start":
             await bot.send_message(chat_id,
                 "👋 Hi! What's your #1 priority today?")
-    return {"ok": True}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", port=8000, reload=True)
+    uvicorn.run(
+        "main:app", port=8000,
+        loop="uvloop", http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        reload=bool(int(os.getenv("DEV", "0"))),   # dev-only file watcher
+    )
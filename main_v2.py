@@ -6,46 +6,110 @@ WiggleBot v0.2  –  ADHD-friendly Telegram accountability coach
 • User replies "done"  → task closed, nags stop
 • User replies "stuck" → GPT-4o mini suggests a micro-action
 
-Storage is in-memory for quick prototyping.
-Swap `tasks` + `active_reminders` for a real DB/queue in production.
+State lives in Redis, so it survives restarts and can be shared by workers:
+  task:<id>         hash(chat_id, text, done, done_ts); expires once closed or abandoned
+  chat:<id>:open    zset of open task ids, scored by creation time
+  reminders         zset of task ids, scored by next reminder time
+  llm:<sha256>      cached coach replies
 """
 
-import os, uuid, asyncio
-from typing import Dict
+import os, uuid, asyncio, html, random, time
+import orjson
+import redis.asyncio as redis
 
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
-from aiogram import Bot, types
+from aiogram import Bot
 from aiogram.client.bot import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from openai import AsyncOpenAI
 
+from llm_cache import RedisReplyCache, cached_reply
+from rate_limiter import RateLimiter
+from retry import with_retry
+
 # ------------------------------------------------------------------ ENV
-load_dotenv()  # pulls BOT_TOKEN, TG_API, OPENAI_API_KEY
+load_dotenv()  # pulls BOT_TOKEN, TG_API, OPENAI_API_KEY, REDIS_URL
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 API_ROOT  = os.getenv("TG_API", "https://api.telegram.org")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+WORKERS   = int(os.getenv("WEB_CONCURRENCY", "1"))
 
 if not (BOT_TOKEN and OPENAI_API_KEY):
     raise RuntimeError("BOT_TOKEN and OPENAI_API_KEY must be set in .env")
 
 # ------------------------------------------------------------------ LIBS
+# one pooled, keep-alive session for every Telegram call
+session = AiohttpSession(api=TelegramAPIServer.from_base(API_ROOT), limit=200)
+session._connector_init.update(limit_per_host=100, ttl_dns_cache=300, keepalive_timeout=75)
 bot = Bot(
     BOT_TOKEN,
-    api_root=API_ROOT,
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML),
 )
 
-oaiclient = AsyncOpenAI()  # auto-reads OPENAI_API_KEY
+r = redis.from_url(REDIS_URL, decode_responses=True)
+
+oaiclient = AsyncOpenAI(max_retries=0)  # auto-reads OPENAI_API_KEY; retries via with_retry
 llm_sema  = asyncio.Semaphore(3)  # max 3 concurrent LLM calls
+# gpt-4o-mini account limits, split evenly so N workers together stay under them
+openai_limiter = RateLimiter(rpm=500 // WORKERS, tpm=200_000 // WORKERS)
+llm_cache = RedisReplyCache(r, ttl=60 * 60)
 
 app = FastAPI()
 
-# ------------------------------------------------------------------ STATE (naïve, RAM)
-tasks: Dict[str, Dict]          = {}  # task_id → dict(chat_id,text,done)
-active_reminders: Dict[str, asyncio.Task] = {}
+@app.on_event("shutdown")
+async def _close_clients():
+    await bot.session.close()
+    await r.aclose()
+
+# ------------------------------------------------------------------ STATE (Redis)
 REMINDER_EVERY = 30 * 60  # seconds (30 min)
+TICK_EVERY     = 1        # seconds between reminder scans
+DONE_TTL       = 24 * 60 * 60  # closed tasks expire after a day
+OPEN_TTL       = 24 * 60 * 60  # open tasks expire a day after the chat's last message
+LEADER_TTL     = 30       # seconds; only the leader worker sends reminders
+WORKER_ID      = uuid.uuid4().hex
+
+def task_key(tid: str) -> str:
+    return f"task:{tid}"
+
+def open_key(chat_id: int) -> str:
+    return f"chat:{chat_id}:open"
+
+# claim due reminders by moving their score to now + interval in one step, so an
+# open task never leaves the zset and a backlog after downtime fires only once
+_claim_due = r.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, tid in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[2], tid)
+end
+return due
+""")
+
+async def oldest_open(chat_id: int):
+    """id of the chat's oldest open task, or None"""
+    while True:
+        ids = await r.zrange(open_key(chat_id), 0, 0)
+        if not ids:
+            return None
+        if await r.exists(task_key(ids[0])):
+            return ids[0]
+        await r.zrem(open_key(chat_id), ids[0])   # task hash expired
+
+async def touch_chat(chat_id: int):
+    """push back the expiry of the chat's open tasks; abandoned ones lapse after OPEN_TTL"""
+    ids = await r.zrange(open_key(chat_id), 0, -1)
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.expire(open_key(chat_id), OPEN_TTL)
+        for tid in ids:
+            pipe.expire(task_key(tid), OPEN_TTL)
+        await pipe.execute()
 
 # ------------------------------------------------------------------ LLM HELPER
 SYSTEM_PROMPT = """
@@ -55,99 +119,187 @@ Rules:
 • Casual tone with an emoji or two.
 • If user is stuck, suggest one concrete next step.
 """
+MAX_WORDS  = 40   # matches the "≤ 40 words" rule; streaming stops here
+
+# new-task acks are canned – no LLM round-trip for a "let's go" line
+ACK_TEMPLATES = [
+    "🚀 Locked in: <b>{t}</b> — let's crush it!",
+    "💪 Got it: <b>{t}</b>. Timer starts now.",
+    "🎯 <b>{t}</b> it is! I'll check in soon.",
+    "🔥 Committed: <b>{t}</b>. You've got this!",
+]
 
+@cached_reply(llm_cache)
 async def coach_reply(reason: str, task_text: str) -> str:
-    """reason = ack | remind | stuck"""
+    """reason = remind | stuck"""
     user_msg = {
-        "ack":   f"I just committed to: {task_text}",
         "remind":f"I haven't finished yet: {task_text}",
         "stuck": f"I'm stuck on: {task_text}",
     }[reason]
 
-    async with llm_sema:  # prevent token flood
-        resp = await oaiclient.chat.completions.create(
+    async def _call():
+        await openai_limiter.aacquire((len(SYSTEM_PROMPT) + len(user_msg)) // 4 + 60)
+        stream = await oaiclient.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role":"system", "content":SYSTEM_PROMPT},
                 {"role":"user",   "content":user_msg}
             ],
             max_tokens=60,
+            stream=True,
         )
-    return resp.choices[0].message.content.strip()
+        buf = []
+        try:
+            async for chunk in stream:
+                if chunk.choices:
+                    buf.append(chunk.choices[0].delta.content or "")
+                words = "".join(buf).split()
+                if len(words) > MAX_WORDS:
+                    # budget hit – stop paying for tokens; the last word may be partial
+                    return " ".join(words[:MAX_WORDS])
+        finally:
+            await stream.close()
+        return "".join(buf).strip()
+
+    async with llm_sema:  # prevent token flood
+        return await with_retry(_call)
 
 # ------------------------------------------------------------------ WEBHOOK
+_background: set = set()   # strong refs so pending updates aren't GC'd
+
 @app.post("/telegram/webhook")
 async def telegram_webhook(req: Request):
-    update = types.Update(**await req.json())
+    # ack Telegram right away; the update is handled in the background
+    payload = orjson.loads(await req.body())
+    task = asyncio.create_task(_process_update(payload))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return ORJSONResponse({"ok": True})
 
-    if not (update.message and update.message.text):
-        return {"ok": True}
+async def _process_update(payload: dict):
+    # fast path: plain text messages are read straight off the dict, no pydantic
+    msg = payload.get("message") or {}
+    if not msg.get("text"):
+        return
 
-    chat_id = update.message.chat.id
-    text    = update.message.text.strip()
+    chat_id = msg["chat"]["id"]
+    text    = msg["text"].strip()
 
-    # ---------- /start ----------
-    if text.lower() == "/start":
-        await bot.send_message(
-            chat_id,
-            "👋 Hi! What's your <b>#1 priority</b> today?\n"
-            "Just reply with a sentence (e.g. <i>Finish project outline</i>)."
-        )
-        return {"ok": True}
-
-    # ---------- mark DONE ----------
-    if text.lower() in {"done", "✅ done", "finished"}:
-        for tid, t in list(tasks.items()):
-            if t["chat_id"] == chat_id and not t["done"]:
-                t["done"] = True
-                reminder = active_reminders.pop(tid, None)
-                if reminder: reminder.cancel()
-                await bot.send_message(chat_id, "🎉 Nice work! Task closed.")
-                break
-        else:
-            await bot.send_message(chat_id, "No open tasks to close. 🎈")
-        return {"ok": True}
-
-    # ---------- STUCK ----------
-    if text.lower() == "stuck":
-        open_task = next(
-            (t for t in tasks.values() if t["chat_id"] == chat_id and not t["done"]),
-            None,
-        )
-        if not open_task:
-            await bot.send_message(chat_id, "I don't see any open tasks 🧐")
-            return {"ok": True}
+    await touch_chat(chat_id)
 
-        tip = await coach_reply("stuck", open_task["text"])
-        await bot.send_message(chat_id, tip)
-        return {"ok": True}
+    handler = _CMDS.get(text.lower())
+    if handler:
+        await handler(chat_id, text)
+        return
 
     # ---------- NEW TASK ----------
     task_id = str(uuid.uuid4())
-    tasks[task_id] = {"chat_id": chat_id, "text": text, "done": False}
+    now = time.time()
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(task_key(task_id), mapping={"chat_id": chat_id, "text": text, "done": 0, "done_ts": 0})
+        pipe.expire(task_key(task_id), OPEN_TTL)
+        pipe.zadd(open_key(chat_id), {task_id: now})
+        pipe.expire(open_key(chat_id), OPEN_TTL)
+        pipe.zadd("reminders", {task_id: now + REMINDER_EVERY})
+        await pipe.execute()
 
-    ack = await coach_reply("ack", text)
+    ack = random.choice(ACK_TEMPLATES).format(t=html.escape(text[:80]))
     await bot.send_message(chat_id, ack)
 
-    loop = asyncio.get_running_loop()
-    active_reminders[task_id] = loop.create_task(reminder_loop(task_id))
+# ---------- /start ----------
+async def _handle_start(chat_id: int, text: str):
+    await bot.send_message(
+        chat_id,
+        "👋 Hi! What's your <b>#1 priority</b> today?\n"
+        "Just reply with a sentence (e.g. <i>Finish project outline</i>)."
+    )
+
+# ---------- mark DONE ----------
+async def _handle_done(chat_id: int, text: str):
+    while True:
+        popped = await r.zpopmin(open_key(chat_id))   # atomic: one close per "done"
+        if not popped:
+            await bot.send_message(chat_id, "No open tasks to close. 🎈")
+            return
+        tid, _ = popped[0]
+        if await r.exists(task_key(tid)):
+            break
+        await r.zrem("reminders", tid)   # task hash expired; drop its leftovers
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(task_key(tid), mapping={"done": 1, "done_ts": time.time()})
+        pipe.expire(task_key(tid), DONE_TTL)
+        pipe.zrem("reminders", tid)
+        await pipe.execute()
+    await bot.send_message(chat_id, "🎉 Nice work! Task closed.")
+
+# ---------- STUCK ----------
+async def _handle_stuck(chat_id: int, text: str):
+    tid = await oldest_open(chat_id)
+    if not tid:
+        await bot.send_message(chat_id, "I don't see any open tasks 🧐")
+        return
 
-    return {"ok": True}
+    task_text = await r.hget(task_key(tid), "text")
+    await bot.send_chat_action(chat_id, "typing")   # covers first-token latency
+    tip = await coach_reply("stuck", task_text)
+    await bot.send_message(chat_id, tip)
+
+# lowercased command text → handler; anything else becomes a new task
+_CMDS = {
+    "/start":  _handle_start,
+    "done":    _handle_done,
+    "✅ done": _handle_done,
+    "finished":_handle_done,
+    "stuck":   _handle_stuck,
+}
 
 # ------------------------------------------------------------------ REMINDER LOOP
-async def reminder_loop(task_id: str):
+# one heartbeat per worker; only the elected leader drains the reminders zset
+@app.on_event("startup")
+async def _start_tick():
+    task = asyncio.create_task(_tick())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+async def _is_leader() -> bool:
+    if await r.set("leader", WORKER_ID, nx=True, ex=LEADER_TTL):
+        return True
+    if await r.get("leader") == WORKER_ID:
+        await r.expire("leader", LEADER_TTL)
+        return True
+    return False
+
+async def _tick():
     while True:
-        await asyncio.sleep(REMINDER_EVERY)
-        t = tasks.get(task_id)
-        if not t or t["done"]:
-            break
         try:
-            msg = await coach_reply("remind", t["text"])
-            await bot.send_message(t["chat_id"], msg)
-        except Exception as e:
-            print("Reminder send error:", e)
+            if await _is_leader():
+                now = time.time()
+                for tid in await _claim_due(keys=["reminders"], args=[now, now + REMINDER_EVERY]):
+                    task = asyncio.create_task(_fire(tid))
+                    _background.add(task)
+                    task.add_done_callback(_background.discard)
+        except redis.RedisError as e:
+            print("Reminder tick error:", e)
+        await asyncio.sleep(TICK_EVERY)
+
+async def _fire(task_id: str):
+    t = await r.hgetall(task_key(task_id))
+    if not t or t["done"] == "1":
+        # closed, or abandoned past OPEN_TTL (its chat:<id>:open entry lapses with it)
+        await r.zrem("reminders", task_id)
+        return
+    try:
+        msg = await coach_reply("remind", t["text"])
+        await with_retry(lambda: bot.send_message(int(t["chat_id"]), msg))
+    except Exception as e:
+        print("Reminder send error:", e)
 
 # ------------------------------------------------------------------ ENTRYPOINT
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run(
+        "main_v2:app", host="0.0.0.0", port=8000,
+        loop="uvloop", http="httptools",
+        workers=WORKERS,
+        reload=bool(int(os.getenv("DEV", "0"))),   # dev-only file watcher
+    )
@@ -12,19 +12,31 @@ Features
 Storage is in-mem; swap for Postgres & Redis when ready.
 """
 
-import os, uuid, asyncio, datetime as dt
-from typing import Dict, List
+import os, uuid, asyncio, datetime as dt, html, random, time, itertools
+import orjson
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Set
 
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from aiogram import Bot, types
 from aiogram.client.bot import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from openai import AsyncOpenAI
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.jobstores.base import JobLookupError
+
+from llm_cache import ReplyCache, cached_reply
+from rate_limiter import RateLimiter
+from retry import with_retry
 
 # ------------------------------------------------------------------ ENV
 load_dotenv()
@@ -33,21 +45,39 @@ OPENAI_API_KEY   = os.getenv("OPENAI_API_KEY")
 API_ROOT         = os.getenv("TG_API", "https://api.telegram.org")
 PACIFIC_UTC_HOUR = 14                         # 7 AM PT == 14 UTC
 FOCUS_MIN        = 25                         # reminder cadence
+MAX_USERS        = 100_000                    # LRU cap on `users`
+DONE_TTL         = 24 * 60 * 60               # closed tasks are swept after a day
+IDLE_TTL         = 7 * 24 * 60 * 60           # finished users' state is dropped after a week idle
+LOCK_IDLE        = 60 * 60                    # chat locks unused this long are pruned
 
 assert BOT_TOKEN and OPENAI_API_KEY, "Set BOT_TOKEN & OPENAI_API_KEY in .env"
 
 # ------------------------------------------------------------------ LIBS
+# one pooled, keep-alive session for every Telegram call
+session = AiohttpSession(api=TelegramAPIServer.from_base(API_ROOT), limit=200)
+session._connector_init.update(limit_per_host=100, ttl_dns_cache=300, keepalive_timeout=75)
 bot = Bot(
     BOT_TOKEN,
-    api_root=API_ROOT,
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML),
 )
-oaiclient = AsyncOpenAI()
+oaiclient = AsyncOpenAI(max_retries=0)   # retries via with_retry
 llm_sema  = asyncio.Semaphore(3)
+openai_limiter = RateLimiter(rpm=500, tpm=200_000)  # gpt-4o-mini account limits
+llm_cache = ReplyCache(max_entries=10_000, ttl=60 * 60)
 
 app = FastAPI()
 sched = AsyncIOScheduler(timezone="UTC")
 
+# started inside the server process (not the launcher) so jobs share its loop
+@app.on_event("startup")
+async def _start_scheduler():
+    sched.start()
+
+@app.on_event("shutdown")
+async def _close_bot_session():
+    await bot.session.close()
+
 # ------------------------------------------------------------------ STATE
 class Task:
     def __init__(self, text: str, priority: str):
@@ -55,8 +85,13 @@ class Task:
         self.text = text
         self.prio = priority  # top | mid | extra
         self.done = False
+        self.done_ts = 0.0
+        self.keyboard = build_keyboard(self.id)   # built once, reused on every nudge
 
-users: Dict[int, Dict] = {}       # chat_id → {tasks: List[Task], pointer:int, reminder:TaskHandle}
+_chat_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)  # serialises each chat's state changes
+_lock_used: Dict[int, float] = {}   # chat_id → last acquire/release of its lock
+subscribers: Set[int] = set()    # every chat that gets the 07:00 prompt; survives eviction
+users: "OrderedDict[int, Dict]" = OrderedDict()  # chat_id → {tasks: List[Task], by_id: Dict[str, Task], open_count:int, pointer:int, reminder:job id, last_seen:float}, LRU order
 
 # ------------------------------------------------------------------ LLM
 SYSTEM_PROMPT = """
@@ -66,18 +101,44 @@ Rules:
 • Suggest 1 concrete action when user is stuck.
 • Celebrate completion with an emoji.
 """
+MAX_WORDS  = 40   # matches the "≤ 40 words" rule; streaming stops here
 
+# morning-plan acks are canned – no LLM round-trip for a "let's go" line
+ACK_TEMPLATES = [
+    "🚀 Plan locked in! First up: <b>{t}</b> — let's crush it!",
+    "💪 Got your list. Starting with <b>{t}</b>.",
+    "🎯 Goals saved! Top priority: <b>{t}</b>.",
+    "🔥 Day planned. Let's knock out <b>{t}</b> first!",
+]
+
+@cached_reply(llm_cache)
 async def gpt(role: str, content: str) -> str:
-    async with llm_sema:
-        res = await oaiclient.chat.completions.create(
+    async def _call():
+        await openai_limiter.aacquire((len(SYSTEM_PROMPT) + len(content)) // 4 + 60)
+        stream = await oaiclient.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user",   "content": content},
             ],
             max_tokens=60,
+            stream=True,
         )
-    return res.choices[0].message.content.strip()
+        buf = []
+        try:
+            async for chunk in stream:
+                if chunk.choices:
+                    buf.append(chunk.choices[0].delta.content or "")
+                words = "".join(buf).split()
+                if len(words) > MAX_WORDS:
+                    # budget hit – stop paying for tokens; the last word may be partial
+                    return " ".join(words[:MAX_WORDS])
+        finally:
+            await stream.close()
+        return "".join(buf).strip()
+
+    async with llm_sema:
+        return await with_retry(_call)
 
 # ------------------------------------------------------------------ HELPERS
 def build_keyboard(task_id: str) -> types.InlineKeyboardMarkup:
@@ -90,7 +151,7 @@ def build_keyboard(task_id: str) -> types.InlineKeyboardMarkup:
 
 def next_task(chat_id: int):
     u = users.get(chat_id)
-    if not u: return None
+    if not u or not u["open_count"]: return None
     while u["pointer"] < len(u["tasks"]) and u["tasks"][u["pointer"]].done:
         u["pointer"] += 1
     return u["tasks"][u["pointer"]] if u["pointer"] < len(u["tasks"]) else None
@@ -101,70 +162,144 @@ async def start_focus(chat_id: int):
         await bot.send_message(chat_id, "🥳 Day’s list complete! Great work.")
         return
     msg = await gpt("coach", f"Start focusing on: {task.text}")
-    await bot.send_message(chat_id, msg, reply_markup=build_keyboard(task.id))
-    # schedule reminder loop
-    loop = asyncio.get_running_loop()
-    users[chat_id]["reminder"] = loop.create_task(remind_loop(chat_id, task.id))
-
-async def remind_loop(chat_id: int, task_id: str):
-    while True:
-        await asyncio.sleep(FOCUS_MIN * 60)
-        u = users.get(chat_id)
-        if not u: return
-        task = next((t for t in u["tasks"] if t.id == task_id), None)
-        if not task or task.done:
-            return
-        nud = await gpt("remind", f"I haven't finished: {task.text}")
-        await bot.send_message(chat_id, nud, reply_markup=build_keyboard(task.id))
+    await bot.send_message(chat_id, msg, reply_markup=task.keyboard)
+    # schedule reminder job (keyed by task id)
+    sched.add_job(_fire_reminder, "interval", minutes=FOCUS_MIN, id=task.id,
+                  args=[chat_id, task.id], replace_existing=True)
+    users[chat_id]["reminder"] = task.id
+
+def cancel_reminder(chat_id: int):
+    tid = users[chat_id]["reminder"]
+    users[chat_id]["reminder"] = None
+    if tid:
+        try:
+            sched.remove_job(tid)
+        except JobLookupError:
+            pass   # already gone
+
+async def _fire_reminder(chat_id: int, task_id: str):
+    u = users.get(chat_id)
+    task = u["by_id"].get(task_id) if u else None
+    if not task or task.done:
+        sched.remove_job(task_id)
+        return
+    nud = await gpt("remind", f"I haven't finished: {task.text}")
+    await with_retry(lambda: bot.send_message(chat_id, nud, reply_markup=task.keyboard))
 
 # ------------------------------------------------------------------ WEBHOOK
+_background: set = set()   # strong refs so pending updates aren't GC'd
+BIG_UPDATE = 4096          # bytes; larger bodies are validated off the event loop
+
+async def parse_update(payload: dict, size: int) -> types.Update:
+    if size > BIG_UPDATE:
+        return await asyncio.to_thread(types.Update.model_validate, payload)
+    return types.Update.model_validate(payload)
+
 @app.post("/telegram/webhook")
 async def telegram_webhook(req: Request):
-    update = types.Update(**await req.json())
-
+    # ack Telegram right away; the update is handled in the background
+    body = await req.body()
+    payload = orjson.loads(body)
+    task = asyncio.create_task(_process_update(payload, len(body)))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return ORJSONResponse({"ok": True})
+
+async def _process_update(payload: dict, size: int):
     # ---------- Callback buttons ----------
-    if update.callback_query:
+    if "callback_query" in payload:
+        update = await parse_update(payload, size)
         data = update.callback_query.data or ""
-        action, tid = data.split(":", 1)
+        action, _, tid = data.partition(":")
         chat_id = update.callback_query.from_user.id
+        touch_user(chat_id)
         await bot.answer_callback_query(update.callback_query.id)
+        if action not in _CB_ACTIONS:
+            return
         if action == "done":
-            mark_done(chat_id, tid)
-            await bot.send_message(chat_id, "🎉 Task marked done!")
-            await start_focus(chat_id)          # move to next
+            async with chat_lock(chat_id):
+                t = users[chat_id]["by_id"].get(tid)
+                if not t or t.done:
+                    return                      # stale or repeated click
+                mark_done(chat_id, tid)
+                await bot.send_message(chat_id, "🎉 Task marked done!")
+                await start_focus(chat_id)      # move to next
         elif action == "stuck":
-            t = get_task(chat_id, tid)
+            t = users[chat_id]["by_id"].get(tid)
+            if not t:
+                return                          # stale button from a swept/old task
+            await bot.send_chat_action(chat_id, "typing")   # covers first-token latency
             tip = await gpt("stuck", f"I'm stuck on: {t.text}")
-            await bot.send_message(chat_id, tip, reply_markup=build_keyboard(t.id))
-        return {"ok": True}
+            await bot.send_message(chat_id, tip, reply_markup=t.keyboard)
+        return
 
-    if not (update.message and update.message.text):
-        return {"ok": True}
+    # fast path: plain text messages are read straight off the dict, no pydantic
+    msg = payload.get("message") or {}
+    if not msg.get("text"):
+        return
 
-    chat_id = update.message.chat.id
-    text    = update.message.text.strip()
+    chat_id = msg["chat"]["id"]
+    text    = msg["text"].strip()
 
     # ensure user record exists
-    users.setdefault(chat_id, {"tasks": [], "pointer": 0, "reminder": None})
+    touch_user(chat_id)
 
-    # ---------- /start ----------
-    if text.lower() == "/start":
-        await bot.send_message(chat_id, "👋 Welcome! I’ll ping you at 7 AM each morning to plan your day.")
-        return {"ok": True}
+    handler = _CMDS.get(text.lower())
+    if handler:
+        await handler(chat_id, text)
+        return
 
     # ---------- handle morning goal list ----------
     if is_morning_input(text):
-        add_tasks_from_morning(chat_id, text)
-        ack = await gpt("ack", "I've planned my goals for today")
-        await bot.send_message(chat_id, ack)
-        await start_focus(chat_id)
-        return {"ok": True}
+        async with chat_lock(chat_id):
+            add_tasks_from_morning(chat_id, text)
+            top = users[chat_id]["tasks"][0].text
+            ack = random.choice(ACK_TEMPLATES).format(t=html.escape(top[:80]))
+            await bot.send_message(chat_id, ack)
+            await start_focus(chat_id)
+        return
 
     # fallback
     await bot.send_message(chat_id, "I didn't catch that. Wait for the morning prompt or press buttons 😉")
-    return {"ok": True}
+
+# ---------- /start ----------
+async def _handle_start(chat_id: int, text: str):
+    await bot.send_message(chat_id, "👋 Welcome! I’ll ping you at 7 AM each morning to plan your day.")
+
+_CMDS = {"/start": _handle_start}   # lowercased command text → handler
+_CB_ACTIONS = {"done", "stuck"}     # valid callback_data prefixes
 
 # ------------------------------------------------------------------ TASK OPS
+@asynccontextmanager
+async def chat_lock(chat_id: int):
+    _lock_used[chat_id] = time.time()
+    async with _chat_locks[chat_id]:
+        try:
+            yield
+        finally:
+            _lock_used[chat_id] = time.time()
+
+def chat_busy(chat_id: int) -> bool:
+    lock = _chat_locks.get(chat_id)
+    return lock is not None and lock.locked()
+
+def touch_user(chat_id: int):
+    """create/refresh the user record and evict the least recently seen past MAX_USERS"""
+    u = users.setdefault(chat_id, {"tasks": [], "by_id": {}, "open_count": 0, "pointer": 0, "reminder": None})
+    u["last_seen"] = time.time()
+    subscribers.add(chat_id)
+    users.move_to_end(chat_id)
+    excess = len(users) - MAX_USERS
+    if excess > 0:
+        # least recently seen first, skipping chats mid-update under their lock
+        for cid in list(itertools.islice((c for c in users if not chat_busy(c)), excess)):
+            drop_user(cid)
+
+def drop_user(chat_id: int):
+    """free a chat's task state; it stays in `subscribers`"""
+    cancel_reminder(chat_id)
+    del users[chat_id]
+
 def is_morning_input(txt: str) -> bool:
     return "\n" in txt   # simplest heuristic
 
@@ -175,9 +310,8 @@ def add_tasks_from_morning(chat_id: int, raw: str):
     extras  = lines[4:]
 
     u = users[chat_id]
-    u["tasks"].clear(); u["pointer"] = 0
-    if u["reminder"]:
-        u["reminder"].cancel()
+    u["tasks"].clear(); u["by_id"].clear(); u["pointer"] = 0
+    cancel_reminder(chat_id)
 
     for l in top:
         u["tasks"].append(Task(l, "top"))
@@ -185,32 +319,83 @@ def add_tasks_from_morning(chat_id: int, raw: str):
         u["tasks"].append(Task(l, "mid"))
     for l in extras:
         u["tasks"].append(Task(l, "extra"))
+    u["by_id"].update((t.id, t) for t in u["tasks"])
+    u["open_count"] = len(u["tasks"])
 
 def get_task(chat_id: int, tid: str) -> Task:
-    return next(t for t in users[chat_id]["tasks"] if t.id == tid)
+    return users[chat_id]["by_id"][tid]
 
 def mark_done(chat_id: int, tid: str):
-    t = get_task(chat_id, tid); t.done = True
+    t = get_task(chat_id, tid)
+    if not t.done:
+        t.done = True
+        t.done_ts = time.time()
+        users[chat_id]["open_count"] -= 1
     # cancel reminder
-    rem = users[chat_id]["reminder"]
-    if rem and not rem.cancelled():
-        rem.cancel()
+    cancel_reminder(chat_id)
+
+# ------------------------------------------------------------------ JANITOR JOB
+@sched.scheduled_job("interval", hours=6)
+async def janitor():
+    now = time.time()
+    for chat_id, u in list(users.items()):
+        if chat_busy(chat_id):
+            continue   # mid-update; sweep it next round
+        if not u["open_count"] and u["last_seen"] < now - IDLE_TTL:
+            drop_user(chat_id)
+            continue
+        stale = {t.id for t in u["tasks"] if t.done and t.done_ts < now - DONE_TTL}
+        if stale:
+            u["tasks"] = [t for t in u["tasks"] if t.id not in stale]
+            for tid in stale:
+                del u["by_id"][tid]
+            u["pointer"] = 0   # next_task re-skips whatever is still done
+
+@sched.scheduled_job("interval", hours=1)
+async def prune_chat_locks():
+    cutoff = time.time() - LOCK_IDLE
+    for chat_id, lock in list(_chat_locks.items()):
+        if not lock.locked() and _lock_used.get(chat_id, 0) < cutoff:
+            del _chat_locks[chat_id]
+            _lock_used.pop(chat_id, None)
 
 # ------------------------------------------------------------------ MORNING PROMPT JOB
+PROMPT_HTML = (
+    "🌞 Good morning!\n"
+    "• Send me <b>ONE top goal</b>.\n"
+    "• <b>THREE medium goals</b> (optional).\n"
+    "• Any extra tasks.\n"
+    "Put each on its own line."
+)
+MORNING_FANOUT = 32   # max concurrent sends
+
+async def _sem_gather(k: int, *aws):
+    """asyncio.gather, but at most k awaitables in flight; errors are returned, not raised"""
+    sem = asyncio.Semaphore(k)
+    async def _w(a):
+        async with sem:
+            return await a
+    return await asyncio.gather(*(_w(a) for a in aws), return_exceptions=True)
+
 @sched.scheduled_job(CronTrigger(hour=PACIFIC_UTC_HOUR, minute=0))
 async def morning_prompt():
-    for chat_id in users.keys():
-        await bot.send_message(
-            chat_id,
-            "🌞 Good morning!\n"
-            "• Send me <b>ONE top goal</b>.\n"
-            "• <b>THREE medium goals</b> (optional).\n"
-            "• Any extra tasks.\n"
-            "Put each on its own line."
-        )
+    cids = list(subscribers)
+    results = await _sem_gather(MORNING_FANOUT, *[
+        with_retry(lambda cid=cid: bot.send_message(cid, PROMPT_HTML)) for cid in cids
+    ])
+    for cid, res in zip(cids, results):
+        if isinstance(res, Exception):
+            print(f"Morning prompt error ({cid}):", res)
+            if isinstance(res, TelegramForbiddenError) or (
+                    isinstance(res, TelegramBadRequest) and "chat not found" in str(res).lower()):
+                subscribers.discard(cid)   # blocked us / chat gone – stop prompting it
 
 # ------------------------------------------------------------------ ENTRYPOINT
 if __name__ == "__main__":
     import uvicorn
-    sched.start()
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run(
+        "main_v3:app", host="0.0.0.0", port=8000,
+        loop="uvloop", http="httptools",
+        workers=1,   # users + scheduler jobs live in this process; more workers would double-send
+        reload=bool(int(os.getenv("DEV", "0"))),   # dev-only file watcher
+    )
@@ -0,0 +1,51 @@
+"""
+Token-bucket limiter for OpenAI requests-per-minute and tokens-per-minute.
+
+`llm_sema` caps how many calls are in flight; this caps how many start per
+minute, so bursts (e.g. the 07:00 fan-out) stay under the account limits
+instead of tripping 429s. The bucket is guarded by a `threading.Lock`, so one
+instance can be shared by sync and async callers.
+"""
+
+import asyncio, threading, time
+
+
+class RateLimiter:
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests: float = rpm    # request bucket
+        self.tokens: float = tpm      # token bucket
+        self.last_refill: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens   = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.last_refill = now
+
+    def _take(self, est_tokens: int) -> float:
+        """Consume capacity and return 0, or return seconds until it's there."""
+        est_tokens = min(est_tokens, self.tpm)   # never wait forever
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.requests >= 1 and self.tokens >= est_tokens:
+                self.requests -= 1
+                self.tokens   -= est_tokens
+                return 0.0
+            req_wait = (1 - self.requests) * 60 / self.rpm if self.requests < 1 else 0.0
+            tok_wait = (est_tokens - self.tokens) * 60 / self.tpm if self.tokens < est_tokens else 0.0
+            return max(req_wait, tok_wait)
+
+    def acquire(self, est_tokens: int):
+        wait = self._take(est_tokens)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._take(est_tokens)
+
+    async def aacquire(self, est_tokens: int):
+        wait = self._take(est_tokens)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._take(est_tokens)
@@ -0,0 +1,33 @@
+"""
+Capped retry with jittered exponential backoff for OpenAI + Telegram calls.
+
+Only transient failures (rate limits, 5xx, network) are retried; anything
+else – bad request, auth, blocked chat – raises on the first attempt.
+"""
+
+import asyncio, random
+from typing import Awaitable, Callable, TypeVar
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+T = TypeVar("T")
+
+TRANSIENT_ERRORS = (
+    RateLimitError, APIConnectionError, InternalServerError,          # OpenAI
+    TelegramNetworkError, TelegramRetryAfter, TelegramServerError,    # Telegram
+)
+
+
+async def with_retry(coro_factory: Callable[[], Awaitable[T]], tries: int = 3, base: float = 0.5) -> T:
+    """Await `coro_factory()` up to `tries` times, sleeping base·2^i (or the
+    server's retry_after) + jitter between."""
+    for i in range(tries):
+        try:
+            return await coro_factory()
+        except TRANSIENT_ERRORS as e:
+            if i == tries - 1:
+                raise
+            # Telegram flood control says exactly how long to back off
+            delay = getattr(e, "retry_after", None) or base * (2 ** i)
+            await asyncio.sleep(delay + random.random() * 0.25)